@@ -1,17 +1,32 @@
 import streamlit as st
 import os
+import io
 import time
 import urllib.parse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import shutil
 import tempfile
-import json
+import xlsxwriter  # 結合結果のExcel書き出し用
+import orjson  # 高速JSONパーサ（Rust実装）
+import hashlib  # AI抽出結果キャッシュのキー生成用
+import numpy as np
 import pandas as pd
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions  # 再試行対象のAPIエラー判定用
 import datetime
 import gc  # メモリ解放用
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED  # 並列ダウンロード・並列AI抽出用
 import re   # JSONクリーニング用
+import threading
+from collections import deque, Counter  # 自動処理の未処理キュー・監査の行数集計用
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# 【修正】pandas 2.x でもCopy-on-Writeを有効にし、結合・列選択時の余分なコピーを避ける（3.0以降は既定で有効）
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # --- 画面設定 ---
 st.set_page_config(page_title="産廃報告書AI抽出アプリ", layout="wide")
@@ -29,9 +44,32 @@ if 'processed_urls' not in st.session_state:
     st.session_state['processed_urls'] = set()
 if 'is_running' not in st.session_state:
     st.session_state['is_running'] = False
-# 監査用：Web上の全ファイルリストを保持（順序保持リスト）
+# 監査用：Web上の全ファイルの (ファイル名, URL) を保持（順序保持リスト）
 if 'all_target_files' not in st.session_state:
     st.session_state['all_target_files'] = []
+# 全履歴を結合した表（履歴に追加するたびに追記していく）
+if 'merged_df' not in st.session_state:
+    st.session_state['merged_df'] = None
+# URLごとの抽出行数（監査レポート用。バッチを記録するたびに数え足す）
+# 別の階層に同名のファイルがあっても区別できるよう、ファイル名ではなくURLで数える
+if 'url_row_counts' not in st.session_state:
+    st.session_state['url_row_counts'] = Counter()
+# 自動実行の開始時点のリンク一覧（実行中はページを取り直さずこれを使う）
+if 'job_links' not in st.session_state:
+    st.session_state['job_links'] = None
+
+# --- Gemini APIの設定（キーが変わった時だけ行う） ---
+@st.cache_resource
+def get_gemini_config_state():
+    """プロセス全体で現在設定中のAPIキーを覚えておく入れ物"""
+    return {"api_key": None}
+
+def configure_gemini(api_key):
+    # 【修正】genai.configureは呼ぶたびにクライアントを作り直すため、再実行のたびには呼ばない
+    state = get_gemini_config_state()
+    if state["api_key"] != api_key:
+        genai.configure(api_key=api_key)
+        state["api_key"] = api_key
 
 # --- サイドバー：設定 ---
 with st.sidebar:
@@ -49,10 +87,13 @@ with st.sidebar:
         st.session_state['processed_urls'] = set()
         st.session_state['is_running'] = False
         st.session_state['all_target_files'] = []
+        st.session_state['job_links'] = None
+        st.session_state['merged_df'] = None
+        st.session_state['url_row_counts'] = Counter()
         st.rerun()
 
     if api_key:
-        genai.configure(api_key=api_key)
+        configure_gemini(api_key)
     st.info("※APIキーがない場合、動作しません。")
 
 # ==========================================
@@ -65,26 +106,131 @@ def get_jst_now_str():
     jst = datetime.timezone(datetime.timedelta(hours=9))
     return datetime.datetime.now(jst).strftime("%Y-%m-%d %H:%M:%S")
 
+# --- ヘルパー：実行履歴への追加 ---
+def add_history(keyword, df):
+    """抽出結果を履歴に追加し、結合済みの表にも追記する"""
+    # 【修正】日本時間を使用
+    now = get_jst_now_str()
+    st.session_state['history'].append({
+        "time": now, "keyword": keyword, "count": len(df), "df": df
+    })
+    # 【修正】全履歴を毎回結合し直さず、今回の分だけを追記する
+    merged = st.session_state['merged_df']
+    st.session_state['merged_df'] = df if merged is None else pd.concat([merged, df], ignore_index=True)
+
+# --- ヘルパー：HTTPセッション（接続プール） ---
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0"}
+
+@st.cache_resource
+def get_http_session():
+    """同一ホストへの接続を使い回すためのrequests.Sessionを返す（プロセス内で1つ）"""
+    session = requests.Session()
+    session.headers.update(HTTP_HEADERS)
+    # 失敗時もレスポンスを返す（raise_on_status=False）ことで従来の挙動を保つ
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# --- ヘルパー：収集対象のリンク（PDF / Excel） ---
+FILE_LINK_SELECTOR = 'a[href$=".pdf" i], a[href$=".xlsx" i], a[href$=".xls" i]'
+# 解析時にhref付きの<a>以外を読み捨てる（ページ全体のツリーを作らない）
+LINK_STRAINER = SoupStrainer("a", href=True)
+
+# --- 共通関数：対象ページからPDF/Excelのリンクを取得（出現順を保持） ---
+# 【修正】同じURL・キーワードでの再実行ではページを取り直さない（10分間キャッシュ）
+# 取得失敗時は例外をそのまま投げ、キャッシュさせずに呼び出し側で表示する
+@st.cache_data(ttl=600, show_spinner=False)
+def get_file_links(target_url, keyword):
+    response = get_http_session().get(target_url, timeout=15)
+    response.raise_for_status()
+    # 【修正】必要なのはリンクだけなので、<a href>以外はツリーに載せない
+    soup = BeautifulSoup(response.content, "lxml", parse_only=LINK_STRAINER)
+    # 拡張子の判定はCSSセレクタ側で行う（大文字小文字は区別しない、出現順で返る）
+    links = soup.select(FILE_LINK_SELECTOR)
+    
+    target_urls = []
+    seen_urls = set() # 重複防止用セット
+    
+    for link in links:
+        full_url = urllib.parse.urljoin(target_url, link["href"])
+        # 重複URLはファイル名の算出前に除外する（順序は出現順のまま）
+        if full_url in seen_urls:
+            continue
+        seen_urls.add(full_url)
+        filename = urllib.parse.unquote(os.path.basename(urllib.parse.urlparse(full_url).path))
+        
+        if not keyword or keyword in filename:
+            target_urls.append((filename, full_url))
+    
+    return target_urls
+
+# --- ヘルパー：ファイルダウンロード（並列実行用） ---
+# 同時ダウンロード数（相手サーバーへの負荷を考えて控えめにする）
+DOWNLOAD_MAX_WORKERS = 6
+
+# ダウンロード時の書き込み単位（ファイル全体をメモリに載せないため）
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+def download_file(session, fname, furl, save_dir):
+    """1ファイルをダウンロードして保存先パスを返す（スレッドから呼ばれるためst.*は使わない）"""
+    # 【修正】同名ファイルが別の階層にあっても上書きし合わないよう、リンクごとのフォルダに保存する
+    os.makedirs(save_dir, exist_ok=True)
+    fpath = os.path.join(save_dir, fname)
+    # 【修正】res.contentで全体をバッファせず、ディスクへ直接ストリーム書き込み
+    with session.get(furl, timeout=(5, 60), stream=True) as res:
+        # 【修正】再試行しても404・5xxのままなら、エラーページを保存せずダウンロード失敗として扱う
+        res.raise_for_status()
+        res.raw.decode_content = True  # gzip等で圧縮されている場合も展開して保存
+        with open(fpath, "wb") as f:
+            shutil.copyfileobj(res.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+    return fpath
+
 # --- ヘルパー：JSONクリーニング関数 ---
+# 【修正】正規表現は起動時に一度だけコンパイルする
+JSON_ARRAY_PATTERN = re.compile(r'\[.*\]', re.DOTALL)
+
 def clean_json_response(text):
-    text = text.strip()
-    if text.startswith("```json"):
-        text = text[7:]
-    if text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    text = text.strip()
-    match = re.search(r'\[.*\]', text, re.DOTALL)
+    """```json などの囲みを外し、JSON配列の部分だけを取り出す"""
+    text = text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+    match = JSON_ARRAY_PATTERN.search(text)
     if match:
         return match.group(0)
     return text
 
+def parse_json_response(text):
+    """AIの応答をJSON配列として読む（JSONモードで素のJSONが返る通常時は、クリーニングを省く）"""
+    try:
+        data = orjson.loads(text)
+        if isinstance(data, list):
+            return data
+    except orjson.JSONDecodeError:
+        pass
+    return orjson.loads(clean_json_response(text))
+
+# --- Excel読み込みエンジン ---
+# 【修正】Rust実装のcalamineで読む（openpyxlより高速で、.xlsも同じエンジンで読める）
+EXCEL_READ_ENGINE = "calamine"
+
+# 見出しセルの改行・半角/全角スペースを一度に取り除く変換表（「委託　量」なども同じ見出しとして扱う）
+HEADER_NORMALIZE_TABLE = str.maketrans({"\n": None, " ": None, "\u3000": None})
+
+def count_keyword_cells(df, keywords):
+    """行ごとに、キーワードを含むセルの数を数えて配列で返す"""
+    # 【修正】シート全体を固定長の文字列配列(<U)にすると、全セルが最長セルの幅でメモリを取るため、1列ずつ検索する
+    counts = np.zeros(len(df), dtype=np.int64)
+    for col_idx in range(df.shape[1]):
+        texts = df.iloc[:, col_idx].astype(str)
+        for kw in keywords:
+            counts += texts.str.contains(kw, regex=False).to_numpy(dtype=bool)
+    return counts
+
 # --- Excel強力読み取り関数 (Pythonロジック) ---
 def read_excel_robust(file_path):
     extracted_data = []
     try:
-        xls = pd.ExcelFile(file_path)
+        xls = pd.ExcelFile(file_path, engine=EXCEL_READ_ENGINE)
         for sheet_name in xls.sheet_names:
             try:
                 df = pd.read_excel(xls, sheet_name=sheet_name, header=None)
@@ -93,77 +239,229 @@ def read_excel_robust(file_path):
             
             target_row_idx = -1
             col_mapping = {} 
-            for r_idx, row in df.iterrows():
-                row_str = row.astype(str).values
-                if any("廃棄物の種類" in s for s in row_str) or any("産業廃棄物の種類" in s for s in row_str):
-                    target_row_idx = r_idx
-                    for c_idx, cell_val in enumerate(row_str):
-                        val = str(cell_val).replace("\n", "").replace(" ", "")
-                        if "種類" in val:
-                            col_mapping["kind"] = c_idx
-                        elif "全処理委託量" in val or "委託量" in val:
-                            col_mapping["amount"] = c_idx
-                    break 
+            # 【修正】見出し行の検索を行ごとのループではなく、列単位の一括検索で行う
+            # （「産業廃棄物の種類」も「廃棄物の種類」を含むため1回の検索で足りる）
+            header_rows = np.flatnonzero(count_keyword_cells(df, ("廃棄物の種類",)))
+            if header_rows.size:
+                target_row_idx = int(header_rows[0])
+                header = df.iloc[target_row_idx].fillna("").astype(str).str.translate(HEADER_NORMALIZE_TABLE)
+                # 同じ見出しが複数ある場合は従来どおり右端の列を採用する
+                is_kind = header.str.contains("種類", regex=False).to_numpy(dtype=bool)
+                kind_cols = np.flatnonzero(is_kind)
+                amount_cols = np.flatnonzero(~is_kind & header.str.contains("委託量", regex=False).to_numpy(dtype=bool))
+                if kind_cols.size:
+                    col_mapping["kind"] = int(kind_cols[-1])
+                if amount_cols.size:
+                    col_mapping["amount"] = int(amount_cols[-1])
             
             if target_row_idx != -1 and "kind" in col_mapping and "amount" in col_mapping:
                 start_row = target_row_idx + 1
-                for i in range(start_row, len(df)):
-                    if col_mapping["kind"] >= len(df.columns) or col_mapping["amount"] >= len(df.columns):
-                        continue
-                    kind_val = df.iloc[i, col_mapping["kind"]]
-                    amount_val = df.iloc[i, col_mapping["amount"]]
-                    if pd.notna(kind_val) and pd.notna(amount_val):
-                        try:
-                            amt_str = str(amount_val).replace(",", "").strip()
-                            amt = float(amt_str)
-                            waste_type = str(kind_val).strip()
-                            if "合計" in waste_type or waste_type == "" or waste_type == "nan":
-                                continue
-                            extracted_data.append({
-                                "提出日": "", "対象年度": "", "文書種類": "報告書", "排出事業者名": "",
-                                "事業の種類": "", "事業場名": "", "住所": "", "自治体名": "",
-                                "廃棄物の種類": waste_type, "⑩全処理委託量_ton": amt, "備考": ""
-                            })
-                        except ValueError:
-                            continue 
+                # 【修正】1セルずつilocで読む代わりに、種類・委託量の2列をまとめて変換・判定する
+                kinds = df.iloc[start_row:, col_mapping["kind"]]
+                amounts = df.iloc[start_row:, col_mapping["amount"]]
+                filled = kinds.notna() & amounts.notna()
+                kinds = kinds[filled].astype(str).str.strip()
+                # 全角数字（「１２．５」など）も数値として読めるようNFKC正規化してから変換する
+                amounts = pd.to_numeric(
+                    amounts[filled].astype(str).str.normalize("NFKC").str.replace(",", "", regex=False).str.strip(),
+                    errors="coerce",
+                ).astype("float64")
+                keep = amounts.notna() & (kinds != "") & (kinds != "nan") & ~kinds.str.contains("合計", regex=False)
+                for waste_type, amt in zip(kinds[keep].tolist(), amounts[keep].tolist()):
+                    extracted_data.append({
+                        "提出日": "", "対象年度": "", "文書種類": "報告書", "排出事業者名": "",
+                        "事業の種類": "", "事業場名": "", "住所": "", "自治体名": "",
+                        "廃棄物の種類": waste_type, "⑩全処理委託量_ton": amt, "備考": ""
+                    })
+            # 【修正】次のシートを読む前に、このシートの表を手放す
+            del df
     except Exception:
         return []
     return extracted_data
 
+# --- ヘルパー：AI抽出結果のキャッシュ（ファイル内容のハッシュで管理） ---
+# プロンプトを変更したら値を変える（古いキャッシュを自動で無効化するため）
+PROMPT_VERSION = "1"
+AI_CACHE_DIR = os.path.join(tempfile.gettempdir(), "pdf_ai_cache")
+
+# ハッシュ計算時の読み込み単位（大きなファイルでも全体をメモリに載せないため）
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def get_file_cache_key(file_path):
+    """ファイル内容とプロンプトのバージョンからキャッシュキー(SHA-256)を作る"""
+    digest = hashlib.sha256()
+    # 【修正】f.read()で丸ごと読まず、一定サイズずつハッシュに流し込む
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    digest.update(PROMPT_VERSION.encode())
+    return digest.hexdigest()
+
+def load_cached_result(cache_key, filename):
+    """キャッシュがあれば抽出結果を返す（ファイル名は今回のものに差し替える）"""
+    cache_path = os.path.join(AI_CACHE_DIR, f"{cache_key}.json")
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, "rb") as f:
+            data_list = orjson.loads(f.read())
+    except Exception:
+        return None
+    for item in data_list:
+        item['ファイル名'] = filename
+    return data_list
+
+def save_cached_result(cache_key, data_list):
+    """抽出結果をキャッシュに保存する（並列実行に備えて一時ファイル経由で置き換える）"""
+    if not data_list:
+        return
+    try:
+        os.makedirs(AI_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=AI_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data_list))
+        os.replace(tmp_path, os.path.join(AI_CACHE_DIR, f"{cache_key}.json"))
+    except Exception:
+        pass
+
+# --- 抽出用プロンプト（全ファイル共通） ---
+# 毎回同じ指示をsystem_instructionとして先頭に置くことで、Gemini側の暗黙キャッシュが効きやすくなる
+# 【修正】備考欄の「AI抽出」を削除し、空欄にする例に変更
+STRICT_PROMPT = """
+あなたはデータ入力の専門家です。資料から産業廃棄物処理の実績データを抽出してください。
+
+【重要規則】
+1. 出力は必ず **以下のJSONフォーマット** に従ってください。キー名は絶対に変更しないでください。
+2. 「実績」の数値を抽出してください。「計画」や「目標」のみの場合は、それを抽出して備考に「計画値」と明記してください。
+3. Markdown記法（```json）は含めないでください。
+
+【JSON出力例】
+[
+  {
+    "提出日": "令和6年6月30日",
+    "対象年度": "令和5年度",
+    "文書種類": "報告書",
+    "排出事業者名": "有限会社〇〇",
+    "事業の種類": "建設業",
+    "事業場名": "〇〇工事現場",
+    "住所": "徳島県...",
+    "自治体名": "徳島県",
+    "廃棄物の種類": "汚泥",
+    "⑩全処理委託量_ton": 100.5,
+    "⑪優良認定処理業者への処理委託量_ton": 0,
+    "⑫再生利用業者への処理委託量_ton": 100.5,
+    "⑬熱回収認定業者への処理委託量_ton": 0,
+    "⑭熱回収認定業者以外の熱回収を行う業者への処理委託量_ton": 0,
+    "備考": ""
+  }
+]
+"""
+
+# PDFと一緒に送る短い指示（本体の指示はSTRICT_PROMPT側）
+PDF_USER_PROMPT = "この資料から実績データを抽出してください。"
+# これより小さいPDFはFile APIを使わずインラインで送る（リクエスト上限20MBに余裕を持たせる）
+INLINE_PDF_MAX_BYTES = 15 * 1024 * 1024
+# File APIでの処理待ちの上限（秒）
+FILE_PROCESSING_TIMEOUT_SEC = 600
+# ExcelをAIに渡す際のテキスト上限（文字数）
+EXCEL_TEXT_MAX_CHARS = 30000
+# 報告表が含まれていそうなシートを見分けるためのキーワード
+EXCEL_RELEVANCE_KEYWORDS = ("廃棄物", "委託量")
+
+def sheet_relevance(df):
+    """見出しとセルのうちキーワードを含むものの数と、キーワードを含む行のマスクを返す（シートの優先順位付け・抜粋用）"""
+    # 【修正】全セルを固定長の文字列配列にせず、列ごとに数える
+    headers = df.columns.astype(str).to_series()
+    header_hits = sum(int(headers.str.contains(kw, regex=False).sum()) for kw in EXCEL_RELEVANCE_KEYWORDS)
+    row_hits = count_keyword_cells(df, EXCEL_RELEVANCE_KEYWORDS)
+    return header_hits + int(row_hits.sum()), row_hits > 0
+
+# 大きなシートをAIに渡す際に残す行数（先頭の行数と、キーワードを含む行から下に続けて残す行数）
+EXCEL_SAMPLE_HEAD_ROWS = 30
+EXCEL_SAMPLE_WINDOW_ROWS = 100
+# CSV化する際の1回あたりの行数（文字数の上限を超えた時点で残りの行を変換しないため）
+CSV_CHUNK_ROWS = 200
+
+def csv_within_limit(df, max_chars):
+    """先頭から一定行ずつCSV化し、max_charsを超えた時点で打ち切る（戻り値は (CSV, 全行を書けたか)）"""
+    parts = [df.iloc[:0].to_csv(index=False)]
+    text_len = len(parts[0])
+    for start in range(0, len(df), CSV_CHUNK_ROWS):
+        if text_len > max_chars:
+            return "".join(parts), False
+        part = df.iloc[start:start + CSV_CHUNK_ROWS].fillna("").to_csv(index=False, header=False)
+        parts.append(part)
+        text_len += len(part)
+    return "".join(parts), text_len <= max_chars
+
+def sheet_to_prompt_csv(df, hit_rows, max_chars):
+    """シートをAIに渡すCSVにする（残りの文字数に収まらない場合だけ、先頭行とキーワードを含む行以降の一定行に絞る）"""
+    # 【修正】シート全体をCSV化してから捨てるのではなく、上限を超えた所で変換を止める
+    text, complete = csv_within_limit(df, max_chars)
+    # 目印になる行がなければ絞り込みようがないので、先頭から文字数上限まで渡す
+    if complete or len(df) <= EXCEL_SAMPLE_HEAD_ROWS or not hit_rows.any():
+        return text
+    # 収まらない場合は、表の見出しとその下のデータ行を優先して残す（キーワード行はsheet_relevanceの結果を使う）
+    keep = np.zeros(len(df), dtype=bool)
+    keep[:EXCEL_SAMPLE_HEAD_ROWS] = True
+    for row in np.flatnonzero(hit_rows):
+        keep[row:row + EXCEL_SAMPLE_WINDOW_ROWS + 1] = True
+    summary = f"(全{len(df)}行・{len(df.columns)}列のうち {int(keep.sum())} 行を抜粋)\n"
+    return summary + csv_within_limit(df[keep], max_chars - len(summary))[0]
+
+# --- ヘルパー：Geminiモデル（プロセス内で使い回す） ---
+PRIMARY_MODEL_NAME = 'gemini-2.5-flash'
+FALLBACK_MODEL_NAME = 'gemini-flash-latest'
+JSON_GENERATION_CONFIG = {"response_mime_type": "application/json"}
+
+@st.cache_resource
+def get_gemini_model(model_name, api_key):
+    """モデルを一度だけ生成する（api_keyはキー変更時に作り直すためのキャッシュキー）"""
+    return genai.GenerativeModel(model_name, system_instruction=STRICT_PROMPT)
+
+# 【修正】1回の生成に上限時間を設け、一時的なエラーの時だけ間隔を空けて再試行する
+GENERATE_TIMEOUT_SEC = 120
+GENERATE_MAX_ATTEMPTS = 3
+# 1ファイルあたりの生成にかける時間の合計上限（再試行と代替モデルを含む）
+GENERATE_TOTAL_TIMEOUT_SEC = 180
+RETRYABLE_API_ERRORS = (
+    google_exceptions.DeadlineExceeded,     # タイムアウト
+    google_exceptions.ResourceExhausted,    # レート制限(429)
+    google_exceptions.ServiceUnavailable,   # 503
+    google_exceptions.InternalServerError,  # 500
+)
+
+def generate_with_retry(model_name, contents, deadline):
+    """指定モデルで生成する（タイムアウト・レート制限・サーバーエラーは1秒→2秒と待って再試行、deadlineを過ぎたら打ち切る）"""
+    model = get_gemini_model(model_name, api_key)
+    for attempt in range(GENERATE_MAX_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise google_exceptions.DeadlineExceeded("1ファイルあたりの生成時間の上限を超えました")
+        try:
+            return model.generate_content(
+                contents, generation_config=JSON_GENERATION_CONFIG,
+                request_options={"timeout": min(GENERATE_TIMEOUT_SEC, remaining)},
+            )
+        except RETRYABLE_API_ERRORS:
+            # 待っている間に期限を過ぎる場合も、待たずにここで打ち切る
+            if attempt == GENERATE_MAX_ATTEMPTS - 1 or time.monotonic() + 2 ** attempt >= deadline:
+                raise
+            time.sleep(2 ** attempt)
+
+def generate_json_content(contents):
+    """標準モデルで生成し、それでも失敗した場合は代替モデルで生成する"""
+    # 【修正】応答しないファイルが1件あるだけでワーカー（とバッチ全体）を長時間止めないよう、
+    # 再試行と代替モデルをまとめて1つの期限で打ち切る
+    deadline = time.monotonic() + GENERATE_TOTAL_TIMEOUT_SEC
+    try:
+        return generate_with_retry(PRIMARY_MODEL_NAME, contents, deadline)
+    except Exception:
+        return generate_with_retry(FALLBACK_MODEL_NAME, contents, deadline)
+
 # --- 共通関数：データ抽出（ハイブリッド・完全版） ---
 def extract_data_with_ai(file_path, filename):
     file_ext = os.path.splitext(filename)[1].lower()
-    
-    # 【修正】備考欄の「AI抽出」を削除し、空欄にする例に変更
-    STRICT_PROMPT = """
-    あなたはデータ入力の専門家です。資料から産業廃棄物処理の実績データを抽出してください。
-    
-    【重要規則】
-    1. 出力は必ず **以下のJSONフォーマット** に従ってください。キー名は絶対に変更しないでください。
-    2. 「実績」の数値を抽出してください。「計画」や「目標」のみの場合は、それを抽出して備考に「計画値」と明記してください。
-    3. Markdown記法（```json）は含めないでください。
-
-    【JSON出力例】
-    [
-      {
-        "提出日": "令和6年6月30日",
-        "対象年度": "令和5年度",
-        "文書種類": "報告書",
-        "排出事業者名": "有限会社〇〇",
-        "事業の種類": "建設業",
-        "事業場名": "〇〇工事現場",
-        "住所": "徳島県...",
-        "自治体名": "徳島県",
-        "廃棄物の種類": "汚泥",
-        "⑩全処理委託量_ton": 100.5,
-        "⑪優良認定処理業者への処理委託量_ton": 0,
-        "⑫再生利用業者への処理委託量_ton": 100.5,
-        "⑬熱回収認定業者への処理委託量_ton": 0,
-        "⑭熱回収認定業者以外の熱回収を行う業者への処理委託量_ton": 0,
-        "備考": ""
-      }
-    ]
-    """
 
     if file_ext in [".xlsx", ".xls"]:
         data_list = read_excel_robust(file_path)
@@ -174,71 +472,250 @@ def extract_data_with_ai(file_path, filename):
                     item["排出事業者名"] = filename
             return data_list
         
+        # 【修正】同じ内容のファイルは前回のAI抽出結果を再利用する
+        cache_key = get_file_cache_key(file_path)
+        cached = load_cached_result(cache_key, filename)
+        if cached is not None:
+            return cached
+
         try:
-            xls = pd.read_excel(file_path, sheet_name=None)
-            text_buffer = f"ファイル名: {filename}\n\n"
+            xls = pd.read_excel(file_path, sheet_name=None, engine=EXCEL_READ_ENGINE)
+            # 【修正】キーワードを多く含むシートから順に並べ、上限に達したら残りのシートは変換しない
+            # （無関係なシートのせいで報告表が文字数上限の外に押し出されないようにする）
+            sheets = []
             for sheet_name, df in xls.items():
-                text_buffer += f"--- Sheet: {sheet_name} ---\n"
-                text_buffer += df.fillna("").to_csv(index=False)
-                text_buffer += "\n\n"
-            if len(text_buffer) > 30000:
-                text_buffer = text_buffer[:30000]
+                score, hit_rows = sheet_relevance(df)
+                sheets.append((score, sheet_name, df, hit_rows))
+            sheets.sort(key=lambda item: item[0], reverse=True)
+            parts = [f"ファイル名: {filename}\n\n"]
+            text_len = len(parts[0])
+            for _, sheet_name, df, hit_rows in sheets:
+                if text_len >= EXCEL_TEXT_MAX_CHARS:
+                    break
+                header = f"--- Sheet: {sheet_name} ---\n"
+                part = header + sheet_to_prompt_csv(df, hit_rows, EXCEL_TEXT_MAX_CHARS - text_len - len(header) - 2) + "\n\n"
+                parts.append(part)
+                text_len += len(part)
+            text_buffer = "".join(parts)[:EXCEL_TEXT_MAX_CHARS]
+            # 【修正】AIの応答を待つ間、読み込んだ全シートを保持し続けない
+            del xls, sheets, parts
 
-            try:
-                model = genai.GenerativeModel('gemini-2.5-flash')
-                response = model.generate_content([STRICT_PROMPT, text_buffer], generation_config={"response_mime_type": "application/json"})
-            except:
-                model = genai.GenerativeModel('gemini-flash-latest')
-                response = model.generate_content([STRICT_PROMPT, text_buffer], generation_config={"response_mime_type": "application/json"})
-
-            json_str = clean_json_response(response.text)
-            ai_data_list = json.loads(json_str)
+            response = generate_json_content([text_buffer])
+
+            ai_data_list = parse_json_response(response.text)
             for item in ai_data_list:
                 item['ファイル名'] = filename
                 if "⑩全処理委託量_ton" not in item: item["⑩全処理委託量_ton"] = 0
+            save_cached_result(cache_key, ai_data_list)
             return ai_data_list
         except Exception:
             return []
 
     elif file_ext == ".pdf":
+        # 【修正】同じ内容のファイルは前回のAI抽出結果を再利用する
+        cache_key = get_file_cache_key(file_path)
+        cached = load_cached_result(cache_key, filename)
+        if cached is not None:
+            return cached
+
         try:
-            try:
-                model = genai.GenerativeModel('gemini-2.5-flash')
-            except:
-                model = genai.GenerativeModel('gemini-flash-latest')
-
-            sample_file = genai.upload_file(path=file_path, display_name=filename)
-            timeout_counter = 0
-            while sample_file.state.name == "PROCESSING":
-                time.sleep(1)
-                timeout_counter += 1
-                sample_file = genai.get_file(sample_file.name)
-                if timeout_counter > 600: return [] 
+            # 【修正】小さいPDFはアップロード＆処理待ちをせず、バイト列をリクエストに直接載せる
+            if os.path.getsize(file_path) < INLINE_PDF_MAX_BYTES:
+                with open(file_path, "rb") as f:
+                    pdf_part = {"mime_type": "application/pdf", "data": f.read()}
+            else:
+                sample_file = genai.upload_file(path=file_path, display_name=filename)
+                # 【修正】1秒固定ではなく、短い間隔から徐々に延ばして処理完了を確認する
+                delay = 0.1
+                waited = 0.0
+                while sample_file.state.name == "PROCESSING":
+                    time.sleep(delay)
+                    waited += delay
+                    delay = min(delay * 1.5, 2.0)
+                    sample_file = genai.get_file(sample_file.name)
+                    if waited > FILE_PROCESSING_TIMEOUT_SEC: return [] 
+                
+                if sample_file.state.name == "FAILED": return []
+                pdf_part = sample_file
             
-            if sample_file.state.name == "FAILED": return []
+            response = generate_json_content([pdf_part, PDF_USER_PROMPT])
             
-            try:
-                response = model.generate_content([sample_file, STRICT_PROMPT], generation_config={"response_mime_type": "application/json"})
-            except:
-                time.sleep(2)
-                response = model.generate_content([sample_file, STRICT_PROMPT], generation_config={"response_mime_type": "application/json"})
-            
-            json_str = clean_json_response(response.text)
-            data_list = json.loads(json_str)
+            data_list = parse_json_response(response.text)
             for item in data_list:
                 item['ファイル名'] = filename
+            save_cached_result(cache_key, data_list)
             return data_list
         except Exception:
             return []
     else:
         return []
 
+# --- 共通関数：複数ファイルのAI抽出を並列実行 ---
+# Gemini APIへの同時リクエスト数（レート制限を考えて控えめにする）
+AI_MAX_WORKERS = 4
+
+def extract_files_concurrently(jobs, on_progress=None):
+    """(file_path, filename) のリストを並列に抽出し、入力順に結合したデータを返す"""
+    results = [None] * len(jobs)
+    # ワーカースレッドからもst.cache_resourceを使えるよう、実行中スクリプトのコンテキストを引き継ぐ
+    ctx = get_script_run_ctx()
+    executor = ThreadPoolExecutor(max_workers=AI_MAX_WORKERS, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+    # 【修正】withで囲むと、再実行・停止で抜ける時に残り全件のAI呼び出しの完了を待ってしまうため、
+    # 抜ける時は未着手の分を取り消し、実行中の分も待たずに戻る
+    try:
+        futures = {executor.submit(extract_data_with_ai, fpath, fname): idx for idx, (fpath, fname) in enumerate(jobs)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            try:
+                results[idx] = future.result()
+            except Exception:
+                results[idx] = []
+            # 進捗表示はメインスレッド（ここ）でのみ行う
+            if on_progress:
+                on_progress(done, jobs[idx][1])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    batch_data = []
+    for extracted in results:
+        if extracted:
+            batch_data.extend(extracted)
+    return batch_data
+
+# --- 共通関数：ダウンロードとAI抽出を重ねて実行（URL自動収集用） ---
+def download_and_extract_concurrently(links, save_dir, on_progress=None):
+    """(filename, url) のリストをダウンロードし、保存できたものから順にAI抽出へ回す
+    戻り値は (リンク順に結合したデータ, 保存できたURL → 抽出行数のdict)"""
+    # 【修正】全件のダウンロード完了を待たず、届いたファイルからAI抽出を始める
+    session = get_http_session()
+    results = [None] * len(links)
+    downloaded_rows = {}
+    total_steps = len(links) * 2  # 1ファイルにつき「ダウンロード」「AI抽出」の2段階
+    done_steps = 0
+    ctx = get_script_run_ctx()
+    download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_WORKERS)
+    ai_executor = ThreadPoolExecutor(max_workers=AI_MAX_WORKERS, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+    # 【修正】withで囲むと、再実行・停止で抜ける時に残りのダウンロードとAI呼び出しの完了を待ってしまうため、
+    # 抜ける時は未着手の分を取り消し、実行中の分も待たずに戻る
+    try:
+        pending = {
+            download_executor.submit(download_file, session, fname, furl, os.path.join(save_dir, str(idx))): ("download", idx)
+            for idx, (fname, furl) in enumerate(links)
+        }
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, idx = pending.pop(future)
+                fname, furl = links[idx]
+                if stage == "download":
+                    try:
+                        fpath = future.result()
+                    except Exception:
+                        done_steps += 2  # ダウンロード失敗時はAI抽出も行わない
+                    else:
+                        downloaded_rows[furl] = 0
+                        pending[ai_executor.submit(extract_data_with_ai, fpath, fname)] = ("extract", idx)
+                        done_steps += 1
+                else:
+                    try:
+                        results[idx] = future.result()
+                    except Exception:
+                        results[idx] = []
+                    downloaded_rows[furl] = len(results[idx] or [])
+                    done_steps += 1
+                # 進捗表示はメインスレッド（ここ）でのみ行う
+                if on_progress:
+                    on_progress(done_steps, total_steps)
+    finally:
+        download_executor.shutdown(wait=False, cancel_futures=True)
+        ai_executor.shutdown(wait=False, cancel_futures=True)
+    batch_data = []
+    for extracted in results:
+        if extracted:
+            batch_data.extend(extracted)
+    return batch_data, downloaded_rows
+
+# --- ヘルパー：メモリ解放 ---
+# 【修正】抽出行数が多いバッチの後だけ明示的にGCを走らせる（小さなバッチでは参照カウントの解放で足りる）
+GC_COLLECT_MIN_ROWS = 1000
+
+def collect_garbage_if_large(row_count):
+    """抽出行数が多い時だけgc.collect()を呼ぶ"""
+    if row_count >= GC_COLLECT_MIN_ROWS:
+        gc.collect()
+
+# --- 共通：台帳の列定義（抽出データのキー → 台帳の列名、この順で並べる） ---
+COLUMN_MAPPING = {
+    'ファイル名': 'ファイル名', '自治体名': '自治体名', '提出日': '提出日',
+    '対象年度': '対象年度', '文書種類': '種類', '事業の種類': '事業の種類',
+    '排出事業者名': '排出事業者名', '事業場名': '事業場名', '住所': '住所',
+    '廃棄物の種類': '廃棄物の種類',
+    '⑩全処理委託量_ton': '⑩全処理委託量(t)',
+    '⑪優良認定処理業者への処理委託量_ton': '⑪優良認定(t)',
+    '⑫再生利用業者への処理委託量_ton': '⑫再生利用(t)',
+    '⑬熱回収認定業者への処理委託量_ton': '⑬熱回収認定(t)',
+    '⑭熱回収認定業者以外の熱回収を行う業者への処理委託量_ton': '⑭熱回収その他(t)',
+    '備考': '備考'
+}
+
+# 【修正】委託量(t)の列は数値型に揃える（AIが "1,234" のような文字列で返す場合も数値化）
+NUMERIC_KEYS = {key for key in COLUMN_MAPPING if key.endswith("_ton")}
+
+# 数値の後ろに付いた単位（全角の「ｔ」もNFKC正規化で「t」になる）
+TON_UNIT_PATTERN = r"\s*(?:t|ton|トン)$"
+
+def to_float_series(values):
+    """カンマ区切りや単位付きの文字列も含む値のリストをfloat64のSeriesに変換する（数値化できない値はNaN）"""
+    # 【修正】read_excel_robustと同じくNFKC正規化し、「100 t」「５トン」のような単位付きの値も数値として読む
+    s = (pd.Series(values, dtype=object).astype(str).str.normalize("NFKC")
+         .str.replace(",", "", regex=False).str.strip()
+         .str.replace(TON_UNIT_PATTERN, "", case=False, regex=True))
+    return pd.to_numeric(s, errors="coerce").astype("float64")
+
+def build_result_df(batch_data):
+    """抽出データ(dictのリスト)を列ごとのリストにまとめ、台帳の列名でDataFrameを一度に作る"""
+    # 【修正】どのバッチでも台帳の全列を同じ順で持たせる（抽出されなかった項目は空欄）
+    # バッチごとに列構成が変わると、結合時に列順が崩れたり型がobjectに落ちたりするため
+    columns = {}
+    # 数値化できなかった委託量は消さずに備考へ残す（行番号 -> メモのリスト）
+    unparsed_notes = {}
+    for key, label in COLUMN_MAPPING.items():
+        values = [item.get(key) for item in batch_data]
+        if key in NUMERIC_KEYS:
+            numbers = to_float_series(values)
+            for row in np.flatnonzero(numbers.isna().to_numpy()):
+                raw = values[row]
+                # 空欄（None・NaN・空文字）はメモにしない
+                if raw is None or (isinstance(raw, float) and np.isnan(raw)) or not str(raw).strip():
+                    continue
+                unparsed_notes.setdefault(row, []).append(f"{label}: {raw}")
+            columns[label] = numbers
+        else:
+            columns[label] = values
+    for row, notes in unparsed_notes.items():
+        remarks = columns[COLUMN_MAPPING['備考']][row]
+        columns[COLUMN_MAPPING['備考']][row] = " / ".join(([str(remarks)] if remarks else []) + notes)
+    return pd.DataFrame(columns)
+
+# xlsxwriterがそのまま書き込める値の型
+EXCEL_CELL_TYPES = (str, int, float, bool, type(None))
+
+# 【修正】一時ファイルを経由せずメモリ上で生成する
+# ダウンロードボタンを押した時にだけ作るため、生成結果はキャッシュしない（全ユーザー分のブックがメモリに残り続けないように）
 def convert_df_to_excel(df):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-        df.to_excel(tmp.name, index=False)
-        with open(tmp.name, "rb") as f:
-            data = f.read()
-    return data
+    buffer = io.BytesIO()
+    # 【修正】pandasのto_excel（列順に書くためconstant_memoryと併用不可）を使わず、xlsxwriterで1行ずつ書き出す
+    # constant_memoryでは書き終えた行をすぐ一時ファイルへ送るため、行数が増えてもメモリ使用量がほぼ一定
+    workbook = xlsxwriter.Workbook(buffer, {"constant_memory": True, "nan_inf_to_errors": True})
+    worksheet = workbook.add_worksheet("Sheet1")
+    # 見出しはpandasのto_excelと同じ書式（太字・罫線・中央揃え）
+    header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    worksheet.write_row(0, 0, [str(col) for col in df.columns], header_format)
+    # 欠損値(NaN/None)は空セルにし、AIが返したリスト等はto_excelと同様に文字列として書く
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, [cell if isinstance(cell, EXCEL_CELL_TYPES) else str(cell) for cell in row])
+    workbook.close()
+    return buffer.getvalue()
 
 # ==========================================
 # タブで機能を切り替え
@@ -263,46 +740,32 @@ with tab1:
                 with tempfile.TemporaryDirectory() as temp_dir:
                     save_dir = os.path.join(temp_dir, "uploads")
                     os.makedirs(save_dir, exist_ok=True)
-                    batch_data = []
-                    status_text.text("AIによる分析を開始します...")
-                    for i, uploaded_file in enumerate(uploaded_files):
-                        file_path = os.path.join(save_dir, uploaded_file.name)
+                    jobs = []
+                    for idx, uploaded_file in enumerate(uploaded_files):
+                        # 【修正】同名のファイルを複数アップロードしても上書きし合わないよう、1件ずつ別フォルダに保存する
+                        file_dir = os.path.join(save_dir, str(idx))
+                        os.makedirs(file_dir, exist_ok=True)
+                        file_path = os.path.join(file_dir, uploaded_file.name)
                         with open(file_path, "wb") as f:
                             f.write(uploaded_file.getbuffer())
-                        status_text.text(f"分析中 ({i+1}/{len(uploaded_files)}): {uploaded_file.name}")
-                        extracted = extract_data_with_ai(file_path, uploaded_file.name)
-                        if extracted:
-                            batch_data.extend(extracted)
-                        progress_bar.progress((i + 1) / len(uploaded_files))
+                        jobs.append((file_path, uploaded_file.name))
+
+                    status_text.text("AIによる分析を開始します...")
+                    # 【修正】AI抽出を並列化（完了したファイルから進捗を更新）
+                    def update_upload_progress(done, fname):
+                        status_text.text(f"分析中 ({done}/{len(jobs)} 件完了): {fname}")
+                        progress_bar.progress(done / len(jobs))
+                    batch_data = extract_files_concurrently(jobs, update_upload_progress)
                     
                     if batch_data:
-                        df = pd.DataFrame(batch_data)
-                        # 列の整理
-                        column_mapping = {
-                            'ファイル名': 'ファイル名', '自治体名': '自治体名', '提出日': '提出日',
-                            '対象年度': '対象年度', '文書種類': '種類', '事業の種類': '事業の種類',
-                            '排出事業者名': '排出事業者名', '事業場名': '事業場名', '住所': '住所',
-                            '廃棄物の種類': '廃棄物の種類',
-                            '⑩全処理委託量_ton': '⑩全処理委託量(t)',
-                            '⑪優良認定処理業者への処理委託量_ton': '⑪優良認定(t)',
-                            '⑫再生利用業者への処理委託量_ton': '⑫再生利用(t)',
-                            '⑬熱回収認定業者への処理委託量_ton': '⑬熱回収認定(t)',
-                            '⑭熱回収認定業者以外の熱回収を行う業者への処理委託量_ton': '⑭熱回収その他(t)',
-                            '備考': '備考'
-                        }
-                        target_cols = [c for c in column_mapping.keys() if c in df.columns]
-                        df = df[target_cols].rename(columns=column_mapping)
-                        
-                        # 【修正】日本時間を使用
-                        now = get_jst_now_str()
-                        st.session_state['history'].append({
-                            "time": now, "keyword": "手動アップロード", "count": len(df), "df": df
-                        })
+                        df = build_result_df(batch_data)
+                        add_history("手動アップロード", df)
                         st.success(f"🎉 分析完了！ {len(df)} 件のデータを抽出しました。")
                         time.sleep(1)
                     else:
                         st.warning("データが抽出できませんでした。")
-                    gc.collect()
+                    collect_garbage_if_large(len(batch_data))
+                    del batch_data
 
 # ------------------------------------------
 # タブ2：URL自動収集 & レポート
@@ -320,44 +783,22 @@ with tab2:
 
     batch_size = st.number_input("自動処理のバッチサイズ", min_value=1, value=50, step=10)
 
-    # 【修正】リンク取得関数（出現順を保持）
-    def get_file_links(target_url, keyword):
-        headers = {"User-Agent": "Mozilla/5.0"}
-        try:
-            response = requests.get(target_url, headers=headers, timeout=15)
-            response.raise_for_status()
-            response.encoding = response.apparent_encoding
-            soup = BeautifulSoup(response.content, "html.parser")
-            links = soup.find_all("a")
-            
-            target_urls = []
-            seen_urls = set() # 重複防止用セット
-            
-            for link in links:
-                href = link.get("href")
-                if href:
-                    href_lower = href.lower()
-                    if href_lower.endswith(".pdf") or href_lower.endswith(".xlsx") or href_lower.endswith(".xls"):
-                        full_url = urllib.parse.urljoin(target_url, href)
-                        filename = os.path.basename(urllib.parse.urlparse(full_url).path)
-                        try: filename = urllib.parse.unquote(filename)
-                        except: pass
-                        
-                        if not keyword or keyword in filename:
-                            # 順序を保持しつつ重複排除
-                            if full_url not in seen_urls:
-                                target_urls.append((filename, full_url))
-                                seen_urls.add(full_url)
-                                
-            return target_urls
-        except Exception as e:
-            st.error(f"エラー: {e}")
-            return []
+    # 【修正】キャッシュ中のリンク一覧を破棄してページを取り直す
+    if st.button("🔄 リンク一覧を再取得", disabled=st.session_state['is_running']):
+        get_file_links.clear()
 
     if target_url:
-        all_file_links = get_file_links(target_url, keyword)
+        # 【修正】実行中は開始時に取得したリンク一覧を使い回す（途中でページが変わっても対象がぶれない）
+        if st.session_state['is_running'] and st.session_state['job_links'] is not None:
+            all_file_links = st.session_state['job_links']
+        else:
+            try:
+                all_file_links = get_file_links(target_url, keyword)
+            except Exception as e:
+                st.error(f"エラー: {e}")
+                all_file_links = []
         # セッションステートに全ファイルリストを保存（順序保持）
-        st.session_state['all_target_files'] = [f[0] for f in all_file_links]
+        st.session_state['all_target_files'] = list(all_file_links)
 
         processed_set = st.session_state['processed_urls']
         unprocessed_links = [link for link in all_file_links if link[1] not in processed_set]
@@ -369,79 +810,50 @@ with tab2:
             if not st.session_state['is_running']:
                 if st.button("🚀 URLからの自動実行を開始", type="primary"):
                     st.session_state['is_running'] = True
+                    st.session_state['job_links'] = all_file_links
                     st.rerun()
         
         if st.session_state['is_running']:
             status_box = st.empty()
             batch_progress = st.progress(0)
+            # 【修正】未処理リンクを毎バッチ全件から作り直さず、キューから順に取り出す
+            pending_links = deque(unprocessed_links)
             
             while remaining_count > 0:
                 if not st.session_state['is_running']: break
-                next_batch = unprocessed_links[:int(batch_size)]
+                next_batch = [pending_links.popleft() for _ in range(min(int(batch_size), len(pending_links)))]
                 status_box.info(f"🔄 自動処理中... 残り {remaining_count} 件")
                 
                 with tempfile.TemporaryDirectory() as temp_dir:
                     save_dir = os.path.join(temp_dir, "downloads")
                     os.makedirs(save_dir, exist_ok=True)
-                    downloaded_files = []
-                    headers = {"User-Agent": "Mozilla/5.0"}
-                    
-                    for i, (fname, furl) in enumerate(next_batch):
-                        try:
-                            res = requests.get(furl, headers=headers, timeout=10)
-                            fpath = os.path.join(save_dir, fname)
-                            with open(fpath, "wb") as f: f.write(res.content)
-                            downloaded_files.append(fpath)
-                            st.session_state['processed_urls'].add(furl)
-                        except: pass
-                        batch_progress.progress((i + 1) / len(next_batch) * 0.5)
+                    # 【修正】ダウンロードとAI抽出を並列かつ重ねて実行（データはリンクの出現順で返る）
+                    batch_data, downloaded_rows = download_and_extract_concurrently(
+                        next_batch, save_dir, lambda done, total: batch_progress.progress(done / total)
+                    )
                     
-                    if downloaded_files:
-                        batch_data = []
-                        for i, fpath in enumerate(downloaded_files):
-                            fname = os.path.basename(fpath)
-                            extracted = extract_data_with_ai(fpath, fname)
-                            if extracted: batch_data.extend(extracted)
-                            batch_progress.progress(0.5 + (i + 1) / len(downloaded_files) * 0.5)
-                        
-                        if batch_data:
-                            df = pd.DataFrame(batch_data)
-                            # 列整理
-                            column_mapping = {
-                                'ファイル名': 'ファイル名', '自治体名': '自治体名', '提出日': '提出日',
-                                '対象年度': '対象年度', '文書種類': '種類', '事業の種類': '事業の種類',
-                                '排出事業者名': '排出事業者名', '事業場名': '事業場名', '住所': '住所',
-                                '廃棄物の種類': '廃棄物の種類',
-                                '⑩全処理委託量_ton': '⑩全処理委託量(t)',
-                                '⑪優良認定処理業者への処理委託量_ton': '⑪優良認定(t)',
-                                '⑫再生利用業者への処理委託量_ton': '⑫再生利用(t)',
-                                '⑬熱回収認定業者への処理委託量_ton': '⑬熱回収認定(t)',
-                                '⑭熱回収認定業者以外の熱回収を行う業者への処理委託量_ton': '⑭熱回収その他(t)',
-                                '備考': '備考'
-                            }
-                            target_cols = [c for c in column_mapping.keys() if c in df.columns]
-                            df = df[target_cols].rename(columns=column_mapping)
-                            
-                            # 【修正】日本時間を使用
-                            now = get_jst_now_str()
-                            st.session_state['history'].append({
-                                "time": now, "keyword": keyword, "count": len(df), "df": df
-                            })
+                    if batch_data:
+                        df = build_result_df(batch_data)
+                        add_history(keyword, df)
+                    # 【修正】処理済みの印は、バッチの結果を履歴に記録した後で付ける
+                    st.session_state['processed_urls'].update(downloaded_rows)
+                    # 監査レポート用に、URLごとの抽出行数を数え足す
+                    st.session_state['url_row_counts'].update(downloaded_rows)
                 
-                del downloaded_files
-                gc.collect()
-                unprocessed_links = [link for link in all_file_links if link[1] not in st.session_state['processed_urls']]
-                remaining_count = len(unprocessed_links)
+                collect_garbage_if_large(len(batch_data))
+                del batch_data
+                # 取得に失敗したリンクはこの実行では再試行しない（次回の開始時に残り件数として再対象になる）
+                remaining_count = len(pending_links)
                 
                 if remaining_count == 0:
                     st.session_state['is_running'] = False
+                    st.session_state['job_links'] = None
                     status_box.success("完了！")
                     st.rerun()
-                else:
-                    time.sleep(1)
 
             if st.button("🛑 中断"):
                 st.session_state['is_running'] = False
+                st.session_state['job_links'] = None
                 st.rerun()
 
 # --- 共通：実行履歴 & 監査レポートエリア ---
@@ -449,8 +861,8 @@ st.markdown("---")
 st.subheader("📂 実行履歴 & 統合ダウンロード")
 
 if len(st.session_state['history']) > 0:
-    all_dfs = [item['df'] for item in st.session_state['history']]
-    merged_df = pd.concat(all_dfs, ignore_index=True)
+    # 結合済みの表はadd_history()で追記済みのものをそのまま使う
+    merged_df = st.session_state['merged_df']
     
     # -----------------------------------------------------
     # 【機能修正】取得状況のレポート（Gap Analysis）
@@ -460,36 +872,27 @@ if len(st.session_state['history']) > 0:
     if st.session_state['all_target_files']:
         # 1. Web上の全ファイルリスト（保存された出現順リストを使用）
         # ※ setを使わず、リストの順序をそのまま使う
-        all_targets_ordered = st.session_state['all_target_files']
+        all_target_links = st.session_state['all_target_files']
+        all_targets_ordered = [fname for fname, _ in all_target_links]
         
-        # 2. 抽出できたファイルリスト（ユニーク）
-        extracted_files = set(merged_df['ファイル名'].unique())
+        # 2. 抽出できたファイルごとの行数
+        # 【修正】結合済みの表を毎回集計せず、バッチ記録時にURLごとに数えておいた行数を使う
+        row_counts = st.session_state['url_row_counts']
         
         # 3. 照合
-        audit_data = []
-        # ここで出現順にループさせることで、レポートの並び順を保証する
-        for fname in all_targets_ordered:
-            if fname in extracted_files:
-                row_count = len(merged_df[merged_df['ファイル名'] == fname])
-                status = "✅ 成功"
-                note = ""
-            else:
-                row_count = 0
-                status = "⚠️ 未取得"
-                note = "要確認"
-            
-            audit_data.append({
-                "ファイル名": fname,
-                "ステータス": status,
-                "抽出行数": row_count,
-                "備考": note
-            })
-        
-        audit_df = pd.DataFrame(audit_data)
+        # 【修正】行ごとのdictではなく列ごとのリストに集めてからDataFrameを作る
+        audit_rows = [row_counts.get(furl, 0) for _, furl in all_target_links]
+        # ここで出現順に並べることで、レポートの並び順を保証する
+        audit_df = pd.DataFrame({
+            "ファイル名": all_targets_ordered,
+            "ステータス": ["✅ 成功" if count else "⚠️ 未取得" for count in audit_rows],
+            "抽出行数": audit_rows,
+            "備考": ["" if count else "要確認" for count in audit_rows]
+        })
         
         # 統計
-        success_count = len(audit_df[audit_df['ステータス'] == "✅ 成功"])
-        fail_count = len(audit_df[audit_df['ステータス'] == "⚠️ 未取得"])
+        fail_count = audit_rows.count(0)
+        success_count = len(audit_rows) - fail_count
         
         col_m1, col_m2 = st.columns(2)
         with col_m1:
@@ -511,12 +914,12 @@ if len(st.session_state['history']) > 0:
     st.markdown("---")
     st.info(f"💡 現在合計 **{len(merged_df)} 行** のデータがあります。")
     
-    merged_excel = convert_df_to_excel(merged_df)
     now_str = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     
     st.download_button(
         label="📦 すべての結果を結合してExcelダウンロード",
-        data=merged_excel,
+        # 【修正】Excelはボタンが押された時に初めて生成する（再実行のたびには作らない）
+        data=lambda: convert_df_to_excel(merged_df),
         file_name=f"waste_report_TOTAL_{now_str}.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         key="download_total_btn",